@@ -1,3 +1,4 @@
+import atexit
 import numpy as np
 from PIL import Image
 from sqlitedict import SqliteDict
@@ -8,7 +9,62 @@ import cv2
 if StrictVersion(cv2.__version__) < StrictVersion('4.2.0'):
     raise ImportError("cv2 version should be 4.2.0 or above")
 
-from utils import rotation_proj, ECC_estimation, feature_matching_estimation
+from utils import rotation_proj, rotation_proj_matrix, ECC_estimation, feature_matching_estimation
+
+CV2_SAVE_INTERVAL = 10    # number of new cv2 transformations after which they are saved to the database
+
+# Arrays of ones shared by all the data, by shape and dtype (read-only)
+_ones = dict()
+
+# In-memory copy of the cv2 transformations of the dataset in use, saved to the database periodically and at exit
+_cv2_transformations = {'dataset': None, 'transformations': None, 'new': 0}
+
+def use_cv2_dataset(dataset):
+    """ Select the dataset of the cv2 transformations and load the ones already calculated """
+    save_cv2_transformations()
+    cv2_transformations = SqliteDict('cv2_transformations.db', autocommit=True)
+    try:
+        cv2_transformations['use_dataset'] = dataset
+        transformations = cv2_transformations[dataset] if dataset in cv2_transformations else dict()
+    finally:
+        cv2_transformations.close()
+    # Transformations saved with "id-id" string keys are converted once to (id, id) keys
+    old_keys = [key for key in transformations if isinstance(key, str)]
+    for key in old_keys:
+        id1, id2 = key.split("-")
+        transformations[(float(id1), float(id2))] = transformations.pop(key)
+    _cv2_transformations.update({'dataset': dataset, 'transformations': transformations, 'new': len(old_keys)})
+    save_cv2_transformations()
+
+def get_cv2_transformations():
+    """ Return the cv2 transformations of the dataset in use, loading them at first call """
+    if _cv2_transformations['transformations'] is None:
+        cv2_transformations = SqliteDict('cv2_transformations.db')
+        try:
+            dataset = cv2_transformations['use_dataset']
+        finally:
+            cv2_transformations.close()
+        use_cv2_dataset(dataset)
+    return _cv2_transformations['transformations']
+
+def add_cv2_transformation(key, transformation):
+    """ Add a new cv2 transformation, saved to the database every CV2_SAVE_INTERVAL new ones """
+    get_cv2_transformations()[key] = transformation
+    _cv2_transformations['new'] += 1
+    if _cv2_transformations['new'] >= CV2_SAVE_INTERVAL:
+        save_cv2_transformations()
+
+def save_cv2_transformations():
+    """ Write the new cv2 transformations to the database """
+    if _cv2_transformations['new'] > 0:
+        cv2_transformations = SqliteDict('cv2_transformations.db', autocommit=True)
+        try:
+            cv2_transformations[_cv2_transformations['dataset']] = _cv2_transformations['transformations']
+        finally:
+            cv2_transformations.close()
+        _cv2_transformations['new'] = 0
+
+atexit.register(save_cv2_transformations)
 
 class RadarData:
     
@@ -18,10 +74,54 @@ class RadarData:
         self.img = img              # array image (0-255)
         self.gps_pos = gps_pos      # 1x3 array
         self.attitude = attitude    # scipy quaternion
+    
+    @property
+    def attitude(self):
+        return self._attitude
+    
+    @attitude.setter
+    def attitude(self, attitude):
+        self._attitude = attitude
+        self._R = None
+        self._quat = None
+    
+    def __setstate__(self, state):
+        # Data pickled before attitude was a property store it as a plain attribute
+        if 'attitude' in state:
+            state['_attitude'] = state.pop('attitude')
+            state['_R'] = None
+            state['_quat'] = None
+        self.__dict__.update(state)
+    
+    @property
+    def R(self):
+        """ Rotation matrix of the attitude (cached until the attitude changes) """
+        if self._R is None:
+            self._R = self.attitude.as_dcm()
+        return self._R
+    
+    @property
+    def quat(self):
+        """ Quaternion of the attitude (cached until the attitude changes) """
+        if self._quat is None:
+            self._quat = self.attitude.as_quat()
+        return self._quat
+        
+    def get_ones(self, dtype=np.float32):
+        """ Return a read-only array of ones with the shape of the image (shared by all the data of this shape) """
+        key = (np.shape(self.img), np.dtype(dtype))
+        if not key in _ones:
+            _ones[key] = np.ones(*key)
+            _ones[key].setflags(write=False)
+        return _ones[key]
         
     def get_img(self):
         """ Return an image of the map (unknown area are set to zero) """ 
-        return Image.fromarray(np.nan_to_num(self.img).astype(np.uint8))
+        if self.img.dtype == np.uint8:
+            return Image.fromarray(self.img)
+        img = np.zeros(np.shape(self.img), np.uint8)
+        np.copyto(img, self.img, casting='unsafe', where=~np.isnan(self.img))
+        return Image.fromarray(img)
         
     def height(self):
         """ Return max y position of a pixel in image frame """
@@ -39,28 +139,24 @@ class RadarData:
     
     def earth2rbd(self,pos, inverse=False):
         """ Change of frame from earth frame to right-backward-down """
-        return self.attitude.apply(pos, inverse)
+        return np.dot(pos, self.R if inverse else self.R.T)
     
     def image_grid(self):
-        """ Give the position of each pixel in the image frame """
-        x, y = np.meshgrid(np.linspace(0, self.width(), np.size(self.img,1)), np.linspace(0, self.height(), np.size(self.img,0)))
-        return np.dstack((x,np.zeros(np.shape(x)),y))
+        """ Give the position of each pixel in the image frame (x as a row, y as a column, to be broadcast) """
+        x = self.precision*np.arange(np.size(self.img,1)).reshape(1,-1)
+        y = self.precision*np.arange(np.size(self.img,0)).reshape(-1,1)
+        return x, y
         
     def earth_grid(self):
         """ give the position of each pixel in the earthframe """
-        img_grid = self.image_grid()
-        earth_grid = self.earth2rbd(img_grid, True) + self.gps_pos
-        return np.reshape(earth_grid, np.shape(img_grid))
+        x, y = self.image_grid()
+        return x[...,None]*self.R[0] + y[...,None]*self.R[2] + self.gps_pos
     
     def image_transformation_from(self, otherdata):
         """ Return the translation and the rotation based on the two radar images """
         translation, rotation = None, None   
         if not (otherdata.id is None or self.id is None):
-            cv2_transformations = SqliteDict('cv2_transformations.db')
-            if cv2_transformations['use_dataset'] in cv2_transformations:
-                if str(self.id)+"-"+str(otherdata.id) in cv2_transformations[cv2_transformations['use_dataset']]:
-                    translation, rotation = cv2_transformations[cv2_transformations['use_dataset']][str(self.id)+"-"+str(otherdata.id)]
-            cv2_transformations.close()
+            translation, rotation = get_cv2_transformations().get((self.id, otherdata.id), (None, None))
             
         if translation is None or rotation is None:
             if not otherdata.id is None:        
@@ -87,14 +183,7 @@ class RadarData:
                 rotation = np.nan
             
             if not (otherdata.id is None or self.id is None) and not np.any(np.isnan(translation)): 
-                cv2_transformations = SqliteDict('cv2_transformations.db', autocommit=True)
-                if not cv2_transformations['use_dataset'] in cv2_transformations:
-                    d = dict()
-                else:
-                    d = cv2_transformations[cv2_transformations['use_dataset']]
-                d[str(self.id)+"-"+str(otherdata.id)] = (translation, rotation)
-                cv2_transformations[cv2_transformations['use_dataset']] = d
-                cv2_transformations.close()  
+                add_cv2_transformation((self.id, otherdata.id), (translation, rotation))
             
         # just for test and vizualisation, could be removed()
         # check_transform(self, rotation, translation, 'radar1_1.png')
@@ -116,38 +205,37 @@ class RadarData:
             attitude = rotation_proj(otherdata.attitude, self.attitude).inv()*otherdata.attitude
         return gps_pos, attitude
     
-    def predict_image(self, gps_pos, attitude, shape=None):
-        """ Give the prediction of an observation in a different position based on actual radar image """
-        exp_rot_matrix = rotation_proj(attitude, self.attitude).as_dcm()[:2,:2]
+    def prediction_matrix(self, gps_pos, attitude):
+        """ Return the affine transformation from actual radar image to an observation in a different position """
+        exp_rot_matrix = rotation_proj_matrix(attitude.as_quat(), self.quat)
         exp_trans = attitude.apply(gps_pos - self.gps_pos)[0:2]/self.precision
-
+        return np.concatenate((exp_rot_matrix, np.array([[-exp_trans[0]],[-exp_trans[1]]])), axis = 1)
+    
+    def predict_image(self, gps_pos, attitude, shape=None):
+        """ Give the prediction of an observation in a different position based on actual radar image
+            Return the predicted image (zero where unknown) and the mask of known pixels (255 if known, 0 otherwise)
+        """
         if shape is None:            
             shape = (np.shape(self.img)[1], np.shape(self.img)[0])
         else:
             shape = (shape[1], shape[0])
         
-        warp_matrix = np.concatenate((exp_rot_matrix, np.array([[-exp_trans[0]],[-exp_trans[1]]])), axis = 1)
+        warp_matrix = self.prediction_matrix(gps_pos, attitude)
         predict_img = cv2.warpAffine(self.img, warp_matrix, shape, flags=cv2.INTER_LINEAR, borderValue = 0);
         
-        mask = cv2.warpAffine(np.ones(np.shape(self.img)), warp_matrix, shape, flags=cv2.INTER_LINEAR, borderValue = 0);
-        diff = mask - np.ones((shape[1], shape[0]))
-        diff[diff != -1] = 0
-        diff[diff == -1] = np.nan
-        prediction = diff + predict_img
-
-        return prediction
+        mask = cv2.warpAffine(self.get_ones(np.uint8), warp_matrix, shape, flags=cv2.INTER_NEAREST, borderValue = 0);
+        np.multiply(mask, 255, out=mask)
+        return predict_img, mask
     
     def image_overlap(self, data2):
         """ Return only the image intersection """
-        w1 = np.ones(np.shape(self.img))
-        w2 = np.ones(np.shape(data2.img))
-    
-        white_1 = RadarData(0,w1,self.gps_pos,self.attitude)
-        white_2 = RadarData(0,w2,data2.gps_pos,data2.attitude)
-    
-        mask1 = white_2.predict_image(self.gps_pos,self.attitude)
-        mask2 = white_1.predict_image(data2.gps_pos,data2.attitude)
+        shape1 = (np.shape(self.img)[1], np.shape(self.img)[0])
+        shape2 = (np.shape(data2.img)[1], np.shape(data2.img)[0])
+        
+        # Valid pixels of each image seen from the other one (values are only 0 or 1)
+        mask1 = cv2.warpAffine(data2.get_ones(self.img.dtype), data2.prediction_matrix(self.gps_pos, self.attitude), shape1, flags=cv2.INTER_NEAREST, borderValue = 0)
+        mask2 = cv2.warpAffine(self.get_ones(data2.img.dtype), self.prediction_matrix(data2.gps_pos, data2.attitude), shape2, flags=cv2.INTER_NEAREST, borderValue = 0)
     
-        out1 = np.multiply(mask1, self.img)
-        out2 = np.multiply(mask2, data2.img)
-        return out1.astype(np.uint8), out2.astype(np.uint8)
+        out1 = cv2.multiply(self.img, mask1, dst=mask1)
+        out2 = cv2.multiply(data2.img, mask2, dst=mask2)
+        return out1.astype(np.uint8, copy=False), out2.astype(np.uint8, copy=False)
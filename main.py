@@ -58,6 +58,7 @@ for ts, radardata in reader:
 # Extracting map after fusion
 if kalman.mapping:    
     m = kalman.mapdata 
+    m.close()                               # close the map file, it is opened again at next use
 
 # Plots
 #recorder.export_map(gps_only = not use_fusion)
@@ -104,6 +105,7 @@ for ts, radardata in reader:
         data = deepcopy(radardata)
         data.gps_pos, data.attitude = pos, att
         kalman.mapdata.show(rbd_translate(pos, att, reader.tracklog_translation), data)             # see the map during localization
+kalman.mapdata.close()
 
 # Plots
 #recorder.export_map()
@@ -8,58 +8,118 @@ from data import RadarData
 import matplotlib.pyplot as plt
 from scipy.spatial.transform import Rotation as rot
 
-from utils import rotation_proj, increase_saturation, merge_img, data_projection, projection
+from utils import rotation_proj_matrix, increase_saturation, merge_img, data_projection, projection
 
 class Map():
     
-    def __init__(self, name = None):
+    def __init__(self, name = None, convert = False):
         self.name = name
         self.img_cov = 10 # covariance of each the pixel value in an image
         
         self.chunk_size = 1000        
-        self.display ={'text': "0 ; 0", 'img': None, 'overlay_fig':None, 'overlay': None, 'scale': 1, 'pos': np.array([0,0,0]), 'axes': None, 'fig':None, 'gps_pos':None} 
+        self.display ={'text': "0 ; 0", 'img': None, 'overlay_fig':None, 'overlay': None, 'scale': 1, 'pos': np.array([0,0,0]), 'axes': None, 'fig':None, 'gps_pos':None, 'map_img': None} 
+        self._hdf5 = None
         
         if name is None:
             # Create a black map
             self.map_name = 'map_'+str(datetime.datetime.now())[0:16].replace(" ","_").replace(":","").replace("-","")
             print("Creating map: map_"+str(datetime.datetime.now())[0:16].replace(" ","_").replace(":","").replace("-","")+'.h5')
             os.makedirs(os.path.dirname('maps/'+self.map_name+'.h5'), exist_ok=True)
-            hdf5 = h5py.File('maps/'+self.map_name+'.h5','a')
-            try:
-                map_hdf5 = hdf5.create_group("map")
-                cov_map_hdf5 = hdf5.create_group("covariance")
-                ini_map = np.nan*np.ones((self.chunk_size, self.chunk_size))
-                ini_cov = np.nan*np.ones((self.chunk_size, self.chunk_size))
-                map_hdf5.create_dataset("0/0", data = ini_map, shape=(self.chunk_size, self.chunk_size) )        
-                cov_map_hdf5.create_dataset("0/0", data = ini_cov, shape=(self.chunk_size, self.chunk_size) ) 
-                self.precision = None
-                self.gps_pos = None
-                self.attitude = None
-            finally:
-                hdf5.close()
+            self.open('a')
+            map_hdf5 = self.create_layer("map", (self.chunk_size, self.chunk_size))
+            self.create_layer("covariance", (self.chunk_size, self.chunk_size))
+            map_hdf5.attrs["ORIGIN"] = np.array([0, 0])
+            self.precision = None
+            self.gps_pos = None
+            self.attitude = None
         else:     
             # Retrieve an already existing map by name
             self.map_name = name
-            hdf5 = h5py.File('maps/'+self.map_name+'.h5','r')
-            try:
-                map_hdf5 = hdf5["map"]
-                self.precision = map_hdf5.attrs["PRECISION"]
-                self.gps_pos = map_hdf5.attrs["POSITION"]
-                self.attitude = rot.from_quat(map_hdf5.attrs["ATTITUDE"])
-            finally:
-                hdf5.close()
+            self.open(convert=convert)
+            map_hdf5 = self.hdf5["map"]
+            self.precision = map_hdf5.attrs["PRECISION"]
+            self.gps_pos = map_hdf5.attrs["POSITION"]
+            self.attitude = rot.from_quat(map_hdf5.attrs["ATTITUDE"])
+
+    @property
+    def hdf5(self):
+        """ HDF5 file of the map, opened at first use and kept open until close() is called """
+        if self._hdf5 is None:
+            self.open()
+        return self._hdf5
+
+    def open(self, mode='r+', convert=False):
+        """ Open the HDF5 file of the map (it must already exist unless mode is 'a') 
+            A map stored with the old chunk layout is converted only if convert is True
+        """
+        path = 'maps/'+self.map_name+'.h5'
+        if mode != 'a' and not os.path.isfile(path):
+            raise FileNotFoundError("Map file not found: "+path)
+        # Chunk cache large enough to hold all the chunks of a partial map
+        self._hdf5 = h5py.File(path, mode, rdcc_nbytes=256*1024**2, rdcc_nslots=10007)
+        if "map" in self._hdf5 and isinstance(self._hdf5["map"], h5py.Group):
+            # Converting rewrites the file in place, so it is only done on request
+            if not convert:
+                self.close()
+                raise Exception("Map "+self.map_name+" uses the old chunk layout, load it once with Map(name, convert=True) to convert it")
+            self.convert_chunk_groups()
+
+    def close(self):
+        """ Close the HDF5 file of the map, it is opened again at next use """
+        if not self._hdf5 is None:
+            self._hdf5.close()
+            self._hdf5 = None
+
+    def __del__(self):
+        if not getattr(self, '_hdf5', None) is None:
+            self.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_hdf5'] = None
+        return state
+
+    def __setstate__(self, state):
+        # Maps pickled before attitude was a property store it as a plain attribute
+        if 'attitude' in state:
+            state['_attitude'] = state.pop('attitude')
+            state['_R'] = None
+            state['_quat'] = None
+        self.__dict__.update(state)
+        self.display.setdefault('map_img', None)
+        # The file is opened at first use, as it may not be needed (e.g. to plot a record)
+        self._hdf5 = None
+
+    @property
+    def attitude(self):
+        return self._attitude
+    
+    @attitude.setter
+    def attitude(self, attitude):
+        self._attitude = attitude
+        self._R = None
+        self._quat = None
+    
+    @property
+    def R(self):
+        """ Rotation matrix of the map attitude (cached until the attitude changes) """
+        if self._R is None:
+            self._R = self.attitude.as_dcm()
+        return self._R
+    
+    @property
+    def quat(self):
+        """ Quaternion of the map attitude (cached until the attitude changes) """
+        if self._quat is None:
+            self._quat = self.attitude.as_quat()
+        return self._quat
 
     def init_map(self, radardata):
         """ Initialize the map with an initial radardata """
-        hdf5 = h5py.File('maps/'+self.map_name+'.h5','a')
-        try:
-            map_hdf5 = hdf5["map"]
-            
-            map_hdf5.attrs["POSITION"] = radardata.gps_pos
-            map_hdf5.attrs["ATTITUDE"] = radardata.attitude.as_quat()
-            map_hdf5.attrs["PRECISION"] = radardata.precision
-        finally:
-            hdf5.close()
+        map_hdf5 = self.hdf5["map"]
+        map_hdf5.attrs["POSITION"] = radardata.gps_pos
+        map_hdf5.attrs["ATTITUDE"] = radardata.attitude.as_quat()
+        map_hdf5.attrs["PRECISION"] = radardata.precision
         
         self.precision = radardata.precision    
         self.gps_pos = deepcopy(radardata.gps_pos) 
@@ -69,52 +129,83 @@ class Map():
         """ Set the covariance of an image added to the map """
         self.img_cov = cov
 
+    def create_layer(self, name, shape):
+        """ Create a resizable layer of the map (image or covariance) stored by compressed chunks and filled with NaN """
+        return self.hdf5.create_dataset(name, shape=shape, maxshape=(None, None), chunks=(self.chunk_size, self.chunk_size), dtype=np.float32, fillvalue=np.nan, compression='lzf', shuffle=True)
+
+    def replace_layer(self, name, shape, blocks):
+        """ Replace a layer of the map by a new one of a given shape, filled with (row, column, array) blocks """
+        hdf5 = self.hdf5
+        attrs = dict(hdf5[name].attrs)
+        layer = self.create_layer(name+"_new", shape)
+        for i, j, block in blocks:
+            if not np.all(np.isnan(block)):
+                layer[i:i+np.shape(block)[0], j:j+np.shape(block)[1]] = block
+        for key in attrs:
+            layer.attrs[key] = attrs[key]
+        del hdf5[name]
+        hdf5.move(name+"_new", name)
+
+    def convert_chunk_groups(self):
+        """ Convert a map stored with one dataset per chunk to a single dataset per layer """
+        hdf5 = self.hdf5
+        chunks = np.array([[int(i), int(j)] for i in hdf5["map"] for j in hdf5["map"][i]])
+        chunk_1, chunk_2 = np.min(chunks, axis=0), np.max(chunks, axis=0)
+        shape = tuple((chunk_2 + 1 - chunk_1)*self.chunk_size)
+        for name in ("map", "covariance"):
+            blocks = (((i-chunk_1[0])*self.chunk_size, (j-chunk_1[1])*self.chunk_size, hdf5[name][str(i)+"/"+str(j)][...]) for i, j in chunks)
+            self.replace_layer(name, shape, blocks)
+        hdf5["map"].attrs["ORIGIN"] = chunk_1
+
+    def fit_map(self, chunk_1, chunk_2):
+        """ Extend the map so that it contains every chunk from chunk_1 to chunk_2 """
+        hdf5 = self.hdf5
+        origin = hdf5["map"].attrs["ORIGIN"]
+        end = origin + np.array(hdf5["map"].shape)//self.chunk_size
+        new_end = np.maximum(end, chunk_2 + 1)
+        if np.all(chunk_1 >= origin):
+            if np.any(new_end != end):
+                for name in ("map", "covariance"):
+                    hdf5[name].resize(tuple((new_end - origin)*self.chunk_size))
+        else:
+            # Layers can only grow at their end, so they are copied to add chunks before the origin.
+            # They grow at least by their actual size to make these copies rare.
+            new_origin = np.where(chunk_1 < origin, np.minimum(chunk_1, 2*origin - end), origin)
+            offset = (origin - new_origin)*self.chunk_size
+            for name in ("map", "covariance"):
+                layer = hdf5[name]
+                blocks = ((offset[0]+i, offset[1]+j, layer[i:i+self.chunk_size, j:j+self.chunk_size]) for i in range(0, layer.shape[0], self.chunk_size) for j in range(0, layer.shape[1], self.chunk_size))
+                self.replace_layer(name, tuple((new_end - new_origin)*self.chunk_size), blocks)
+            hdf5["map"].attrs["ORIGIN"] = new_origin
+
     def build_partial_map(self, otherdata):
         """ Build partial map of the chunks that are needed to contain the new data """
-        hdf5 = h5py.File('maps/'+self.map_name+'.h5','a')
-        try:
-            map_hdf5 = hdf5["map"]
-            cov_map_hdf5 = hdf5["covariance"]
-            
-            q = rotation_proj(self.attitude, otherdata.attitude)
-            P5 = self.attitude.apply(otherdata.gps_pos - self.gps_pos)[0:2]
-            P6 = P5 + q.apply(np.array([otherdata.width(),0,0]))[0:2]
-            P7 = P5 + q.apply(np.array([otherdata.width(),otherdata.height(),0]))[0:2]
-            P8 = P5 + q.apply(np.array([0,otherdata.height(),0]))[0:2]
-            
-            P9 = np.array([min(P5[0],P6[0],P7[0],P8[0]),min(P5[1],P6[1],P7[1],P8[1])])
-            P10 = np.array([max(P5[0],P6[0],P7[0],P8[0]),max(P5[1],P6[1],P7[1],P8[1])])
-            
-            chunk_1 = np.flip(np.floor((P9/self.precision)/self.chunk_size).astype(np.int))
-            chunk_2 = np.flip(np.floor((P10/self.precision)/self.chunk_size).astype(np.int))
-            
-            img = np.nan*np.ones((self.chunk_size*(1+chunk_2[0]-chunk_1[0]), self.chunk_size*(1+chunk_2[1]-chunk_1[1])))
-            cov_img = np.nan*np.ones((self.chunk_size*(1+chunk_2[0]-chunk_1[0]), self.chunk_size*(1+chunk_2[1]-chunk_1[1])))
-            
-            for i in range(chunk_1[0], chunk_2[0]+1):
-                for j in range(chunk_1[1], chunk_2[1]+1):
-                    if not str(i)+"/"+str(j) in map_hdf5:
-                        map_hdf5.create_dataset(str(i)+"/"+str(j), data = np.nan*np.ones((self.chunk_size, self.chunk_size)), shape=(self.chunk_size, self.chunk_size) )        
-                        cov_map_hdf5.create_dataset(str(i)+"/"+str(j), data = np.nan*np.ones((self.chunk_size, self.chunk_size)), shape=(self.chunk_size, self.chunk_size) ) 
-                    img[(i-chunk_1[0])*self.chunk_size:(i-chunk_1[0]+1)*self.chunk_size, (j-chunk_1[1])*self.chunk_size:(j-chunk_1[1]+1)*self.chunk_size] = map_hdf5[str(i)+"/"+str(j)]
-                    cov_img[(i-chunk_1[0])*self.chunk_size:(i-chunk_1[0]+1)*self.chunk_size, (j-chunk_1[1])*self.chunk_size:(j-chunk_1[1]+1)*self.chunk_size] = cov_map_hdf5[str(i)+"/"+str(j)]
-            gps_pos = self.gps_pos + self.attitude.inv().apply(np.array([chunk_1[1]*self.chunk_size*self.precision, chunk_1[0]*self.chunk_size*self.precision, 0]))
-        finally:            
-            hdf5.close()
+        P5 = self.R.dot(otherdata.gps_pos - self.gps_pos)[0:2]
+        corners = np.array([[0, 0], [otherdata.width(), 0], [otherdata.width(), otherdata.height()], [0, otherdata.height()]])
+        P5_P8 = P5 + corners.dot(rotation_proj_matrix(self.quat, otherdata.quat).T)
+        
+        P9 = np.min(P5_P8, axis=0)
+        P10 = np.max(P5_P8, axis=0)
+        
+        chunk_1 = np.flip(np.floor((P9/self.precision)/self.chunk_size).astype(np.int))
+        chunk_2 = np.flip(np.floor((P10/self.precision)/self.chunk_size).astype(np.int))
+        
+        self.fit_map(chunk_1, chunk_2)
+        start = (chunk_1 - self.hdf5["map"].attrs["ORIGIN"])*self.chunk_size
+        end = (chunk_2 + 1 - self.hdf5["map"].attrs["ORIGIN"])*self.chunk_size
+        img = self.hdf5["map"][start[0]:end[0], start[1]:end[1]]
+        cov_img = self.hdf5["covariance"][start[0]:end[0], start[1]:end[1]]
+        gps_pos = self.gps_pos + self.R.T.dot(np.array([chunk_1[1]*self.chunk_size*self.precision, chunk_1[0]*self.chunk_size*self.precision, 0]))
         return img, cov_img, gps_pos
     
     def update_map(self, img, cov_img, pos):
         """ Updating part of the map with a given image """
-        hdf5 = h5py.File('maps/'+self.map_name+'.h5','a')
-        map_hdf5 = hdf5["map"]
-        cov_map_hdf5 = hdf5["covariance"]
-        
-        chunk = np.flip(np.round((self.attitude.apply(pos - self.gps_pos)[0:2]/self.precision)/self.chunk_size).astype(np.int))
-        for i in range(chunk[0], chunk[0]+int(np.ceil(np.shape(img)[0]/self.chunk_size))):
-            for j in range(chunk[1], chunk[1]+int(np.ceil(np.shape(img)[1]/self.chunk_size))):
-                map_hdf5[str(i)+"/"+str(j)][...] = img[(i-chunk[0])*self.chunk_size:(i-chunk[0]+1)*self.chunk_size, (j-chunk[1])*self.chunk_size:(j-chunk[1]+1)*self.chunk_size]
-                cov_map_hdf5[str(i)+"/"+str(j)][...] = cov_img[(i-chunk[0])*self.chunk_size:(i-chunk[0]+1)*self.chunk_size, (j-chunk[1])*self.chunk_size:(j-chunk[1]+1)*self.chunk_size]
-        hdf5.close()
+        chunk = np.flip(np.round((self.R.dot(pos - self.gps_pos)[0:2]/self.precision)/self.chunk_size).astype(np.int))
+        start = (chunk - self.hdf5["map"].attrs["ORIGIN"])*self.chunk_size
+        self.hdf5["map"][start[0]:start[0]+np.shape(img)[0], start[1]:start[1]+np.shape(img)[1]] = img
+        self.hdf5["covariance"][start[0]:start[0]+np.shape(img)[0], start[1]:start[1]+np.shape(img)[1]] = cov_img
+        # Write the chunk cache to disk so that a crash does not lose the merged data
+        self.hdf5.flush()
                 
     def add_data(self, otherdata):
         """ Fusionning a new radardata with part of the map """
@@ -124,19 +215,35 @@ class Map():
         img1, cov_img1, new_origin = self.build_partial_map(otherdata)
         shape = np.shape(img1)
         
-        v2 = self.attitude.apply(otherdata.gps_pos - new_origin)[0:2]/self.precision
-        M2 = np.concatenate((rotation_proj(self.attitude, otherdata.attitude).as_dcm()[:2,:2],np.array([[v2[0]],[v2[1]]])), axis = 1)
+        v2 = self.R.dot(otherdata.gps_pos - new_origin)[0:2]/self.precision
+        M2 = np.concatenate((rotation_proj_matrix(self.quat, otherdata.quat),np.array([[v2[0]],[v2[1]]])), axis = 1)
         img2 = cv2.warpAffine(otherdata.img, M2, (shape[1], shape[0]), flags=cv2.INTER_LINEAR, borderValue = 0)
-        mask = cv2.warpAffine(np.ones(np.shape(otherdata.img)), M2, (shape[1], shape[0]), flags=cv2.INTER_LINEAR, borderValue = 0);
-        diff = mask - np.ones(shape)
+        mask = cv2.warpAffine(otherdata.get_ones(), M2, (shape[1], shape[0]), flags=cv2.INTER_LINEAR, borderValue = 0);
+        diff = np.subtract(mask, 1, out=mask)
         diff[diff != 0] = np.nan
         img2 = diff + img2
         
-        cov_img2 = cv2.warpAffine(self.img_cov*np.ones(np.shape(otherdata.img)), M2, (shape[1], shape[0]), flags=cv2.INTER_LINEAR, borderValue = 0)
-        cov_img2 = diff + cov_img2
-
-        img, cov_img = merge_img(img1, img2, cov_img1, cov_img2)
+        # Warp of a constant covariance is the covariance times the mask, which is 1 wherever diff is not NaN
+        cov_img2 = diff + np.float32(self.img_cov)
+        
+        # Restrict the fusion to the bounding box of the new image in the partial map
+        w, h = np.size(otherdata.img,1)-1, np.size(otherdata.img,0)-1
+        corners = M2[:,:2].dot(np.array([[0, w, w, 0], [0, 0, h, h]])) + M2[:,2:]
+        P_start = np.maximum(np.floor(np.min(corners, axis=1)).astype(int), 0)
+        P_end = np.minimum(np.ceil(np.max(corners, axis=1)).astype(int) + 1, [shape[1], shape[0]])
+        sl = (slice(P_start[1], P_end[1]), slice(P_start[0], P_end[0]))
+        if not np.any(~np.isnan(img2[sl])):
+            # Nothing new to add in the map
+            return img1, img2, v2
+        
+        if np.isnan(img1[sl]).all():
+            # Area not mapped yet, no need to merge
+            img, cov_img = img1.copy(), cov_img1.copy()
+            img[sl], cov_img[sl] = img2[sl], cov_img2[sl]
+        else:
+            img, cov_img = merge_img(img1, img2, cov_img1, cov_img2, sl)
         self.update_map(img, cov_img, new_origin)
+        self.display['map_img'] = None
         return img1, img2, v2
         
     def show(self, gps_pos = None, overlay=None):
@@ -152,6 +259,7 @@ class Map():
         border = 2
                 
         def press(event):
+            prev_pos = self.display['pos']
             if event.key == 'left':
                 self.display['pos'] = self.display['pos'] - np.array([self.display['scale']*speed_trans*self.precision,0,0])
             elif event.key == 'right':
@@ -161,11 +269,17 @@ class Map():
             elif event.key == 'down':               
                 self.display['pos'] = self.display['pos'] + np.array([0,self.display['scale']*speed_trans*self.precision,0])
             center = -self.precision*np.array([0.5*shape[1], 0.5*shape[0],0])
-            img, _ = self.extract_from_map(self.display['gps_pos']+self.attitude.apply(self.display['pos']+center,True), self.attitude, shape, self.display['scale'])
+            # Shift of the displayed image in pixels, only the new borders are extracted if it stays visible
+            shift = self.display['scale']*(self.display['pos'] - prev_pos)[0:2]/self.precision
+            if not self.display['map_img'] is None and np.allclose(shift, np.round(shift)) and np.all(np.abs(shift) < np.flip(shape)):
+                img = self.extract_shifted(self.display['map_img'], self.display['gps_pos']+self.R.T.dot(self.display['pos']+center), np.round(shift).astype(int), self.display['scale'])
+            else:
+                img, _ = self.extract_from_map(self.display['gps_pos']+self.R.T.dot(self.display['pos']+center), self.attitude, shape, self.display['scale'])
+            self.display['map_img'] = img
             self.display['img'].set_data(increase_saturation(np.nan_to_num(img)))
             
             if not self.display['overlay'] is None:
-                img_overlay = np.nan_to_num(self.display['overlay'].predict_image(self.display['gps_pos'] + self.attitude.apply(self.display['pos']+center,True), self.attitude, (int(np.ceil(shape[0]/self.display['scale'])), int(np.ceil(shape[1]/self.display['scale'])))))
+                img_overlay, _ = self.display['overlay'].predict_image(self.display['gps_pos'] + self.R.T.dot(self.display['pos']+center), self.attitude, (int(np.ceil(shape[0]/self.display['scale'])), int(np.ceil(shape[1]/self.display['scale']))))
                 overlay_red = np.zeros((np.shape(img_overlay)[0], np.shape(img_overlay)[1], 4))
                 overlay_red[:,:,0] = img_overlay
                 overlay_red[:,:,3] = (img_overlay != 0)*overlay_alpha*255
@@ -182,11 +296,12 @@ class Map():
                     self.display['scale'] = scroll_limit
                     
             center = -self.precision*np.array([0.5*shape[1], 0.5*shape[0],0])
-            img, _ = self.extract_from_map(self.display['gps_pos']+self.attitude.apply(self.display['pos'] + center, True), self.attitude, shape, self.display['scale'])           
+            img, _ = self.extract_from_map(self.display['gps_pos']+self.R.T.dot(self.display['pos'] + center), self.attitude, shape, self.display['scale'])           
+            self.display['map_img'] = img
             self.display['img'].set_data(increase_saturation(np.nan_to_num(img)))
             
             if not self.display['overlay'] is None:
-                img_overlay = np.nan_to_num(self.display['overlay'].predict_image(self.display['gps_pos']+self.attitude.apply(self.display['pos'] + center,True), self.attitude, (int(np.ceil(shape[0]/self.display['scale'])), int(np.ceil(shape[1]/self.display['scale'])))))
+                img_overlay, _ = self.display['overlay'].predict_image(self.display['gps_pos']+self.R.T.dot(self.display['pos'] + center), self.attitude, (int(np.ceil(shape[0]/self.display['scale'])), int(np.ceil(shape[1]/self.display['scale']))))
                 overlay_red = np.zeros((np.shape(img_overlay)[0], np.shape(img_overlay)[1], 4))
                 overlay_red[:,:,0] = img_overlay
                 overlay_red[:,:,3] = (img_overlay != 0)*overlay_alpha*255
@@ -212,7 +327,7 @@ class Map():
         center = -self.precision*np.array([0.5*shape[1], 0.5*shape[0],0])
         if not overlay is None:
             self.display['overlay'] = data_projection(self.gps_pos, self.attitude, overlay)
-            img_border = 255*np.ones(np.shape(overlay.img))
+            img_border = np.full(np.shape(overlay.img), 255, np.uint8)
             img_border[border:-border,border:-border] = overlay.img[border:-border,border:-border]
             self.display['overlay'].img = img_border
         else:
@@ -233,12 +348,13 @@ class Map():
                 [self.display['axes'].spines[spine].set_color('white') for spine in self.display['axes'].spines]        
 
             if self.gps_pos is None:
-                img = np.nan*np.ones(shape)
+                img = np.full(shape, np.nan, np.float32)
             else:
-                img, _ = self.extract_from_map(self.display['gps_pos'] + self.attitude.apply(self.display['pos'] + center,True), self.attitude, shape, self.display['scale'])
+                img, _ = self.extract_from_map(self.display['gps_pos'] + self.R.T.dot(self.display['pos'] + center), self.attitude, shape, self.display['scale'])
+                self.display['map_img'] = img
             self.display['img'] = self.display['axes'].imshow(increase_saturation(np.nan_to_num(img)), cmap='gray', vmin=0, vmax=255, zorder=1)
             if not self.display['overlay'] is None:
-                img_overlay = np.nan_to_num(self.display['overlay'].predict_image(self.display['gps_pos'] + self.attitude.apply(self.display['pos']+ center,True), self.attitude, (int(np.ceil(shape[0]/self.display['scale'])), int(np.ceil(shape[1]/self.display['scale'])))))
+                img_overlay, _ = self.display['overlay'].predict_image(self.display['gps_pos'] + self.R.T.dot(self.display['pos']+ center), self.attitude, (int(np.ceil(shape[0]/self.display['scale'])), int(np.ceil(shape[1]/self.display['scale']))))
                 overlay_red = np.zeros((np.shape(img_overlay)[0], np.shape(img_overlay)[1], 4))
                 overlay_red[:,:,0] = img_overlay
                 overlay_red[:,:,3] = (img_overlay != 0)*overlay_alpha*255
@@ -247,13 +363,14 @@ class Map():
             plt.show()
         else:
             if self.gps_pos is None:
-                img = np.nan*np.ones(shape)
+                img = np.full(shape, np.nan, np.float32)
             else:
-                img, _ = self.extract_from_map(self.display['gps_pos']+self.attitude.apply(self.display['pos'] + center,True), self.attitude, shape, self.display['scale'])
+                img, _ = self.extract_from_map(self.display['gps_pos']+self.R.T.dot(self.display['pos'] + center), self.attitude, shape, self.display['scale'])
+                self.display['map_img'] = img
             self.display['img'].set_data(increase_saturation(np.nan_to_num(img)))
             
             if not self.display['overlay'] is None:
-                img_overlay = np.nan_to_num(self.display['overlay'].predict_image(self.display['gps_pos']+self.attitude.apply(self.display['pos'] + center,True), self.attitude, (int(np.ceil(shape[0]/self.display['scale'])), int(np.ceil(shape[1]/self.display['scale'])))))
+                img_overlay, _ = self.display['overlay'].predict_image(self.display['gps_pos']+self.R.T.dot(self.display['pos'] + center), self.attitude, (int(np.ceil(shape[0]/self.display['scale'])), int(np.ceil(shape[1]/self.display['scale']))))
                 overlay_red = np.zeros((np.shape(img_overlay)[0], np.shape(img_overlay)[1], 4))
                 overlay_red[:,:,0] = img_overlay
                 overlay_red[:,:,3] = (img_overlay != 0)*overlay_alpha*255
@@ -272,14 +389,28 @@ class Map():
         
     def extract_from_map(self, gps_pos, attitude, shape, scale=1):
         """ Return an image from the map for a given position and attitude and with a given shape """
-        data_temp = RadarData(0, np.ones((int(np.ceil(shape[0]/scale)), int(np.ceil(shape[1]/scale)))), gps_pos, attitude, self.precision)
+        data_temp = RadarData(0, np.empty((int(np.ceil(shape[0]/scale)), int(np.ceil(shape[1]/scale))), np.uint8), gps_pos, attitude, self.precision)
         img1, cov_img1, new_origin = self.build_partial_map(data_temp)
 
-        P_start = self.attitude.apply(new_origin - gps_pos)[0:2]/self.precision
-        R = rotation_proj(self.attitude, attitude).inv().as_dcm()[:2,:2]
+        P_start = self.R.dot(new_origin - gps_pos)[0:2]/self.precision
+        R = rotation_proj_matrix(self.quat, attitude.as_quat()).T
         M2 = np.concatenate((R,R.dot(np.array([[P_start[0]],[P_start[1]]]))), axis = 1)
 
         M2 = scale*np.eye(2).dot(M2)
         img2 = cv2.warpAffine(img1, M2, (shape[1], shape[0]), flags=cv2.INTER_LINEAR, borderValue = 0)
         cov_img2 = cv2.warpAffine(cov_img1, M2, (shape[1], shape[0]), flags=cv2.INTER_LINEAR, borderValue = 0)
-        return img2, cov_img2
\ No newline at end of file
+        return img2, cov_img2
+
+    def extract_shifted(self, img, gps_pos, shift, scale=1):
+        """ Return the image of the map at gps_pos from an image extracted before and shifted by an integer number of pixels 
+            Only the borders of the image that were not in the previous image are extracted from the map
+        """
+        shape = np.shape(img)
+        new_img = np.roll(img, (-shift[1], -shift[0]), axis=(0,1))
+        if shift[0] != 0:
+            col = shape[1]-shift[0] if shift[0] > 0 else 0
+            new_img[:, col:col+abs(shift[0])], _ = self.extract_from_map(gps_pos + self.R.T.dot(np.array([col*self.precision/scale, 0, 0])), self.attitude, (shape[0], abs(shift[0])), scale)
+        if shift[1] != 0:
+            row = shape[0]-shift[1] if shift[1] > 0 else 0
+            new_img[row:row+abs(shift[1]), :], _ = self.extract_from_map(gps_pos + self.R.T.dot(np.array([0, row*self.precision/scale, 0])), self.attitude, (abs(shift[1]), shape[1]), scale)
+        return new_img
@@ -0,0 +1,19 @@
+import math
+import numpy as np
+from numba import njit, prange
+
+@njit(parallel=True, cache=True)
+def merge_kernel(img1, img2, P1, P2, out_img, out_cov, r0, r1, c0, c1):
+    """ Merge img2 into out_img (initialized with img1) between rows r0:r1 and columns c0:c1, weighted by uncertainty """
+    for i in prange(r0, r1):
+        for j in range(c0, c1):
+            v1 = img1[i,j]
+            v2 = img2[i,j]
+            if math.isnan(v1):
+                out_img[i,j] = v2
+                out_cov[i,j] = P2[i,j]
+            elif not math.isnan(v2):
+                p1 = P1[i,j]
+                p2 = P2[i,j]
+                out_img[i,j] = np.rint((v1*p2 + v2*p1)/(p1 + p2))
+                out_cov[i,j] = p1*p2/(p1 + p2)
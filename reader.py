@@ -3,9 +3,8 @@ import h5py
 import numpy as np
 from PIL import Image
 from copy import deepcopy
-from data import RadarData
+from data import RadarData, use_cv2_dataset
 import matplotlib.pyplot as plt
-from sqlitedict import SqliteDict
 from recorder import Plot_Handler
 from matplotlib.animation import ArtistAnimation
 from scipy.spatial.transform import Slerp
@@ -59,9 +58,7 @@ class Reader(Plot_Handler):
         """ Function load radar data magnitude from HDF5 between t_ini and t_final"""
         hdf5 = h5py.File(self.src,'r+')
         
-        cv2_transformations = SqliteDict('cv2_transformations.db', autocommit=True)
-        cv2_transformations['use_dataset'] = self.src
-        cv2_transformations.close()
+        use_cv2_dataset(self.src)
         
         try:
             aperture = hdf5['radar']['broad01']['aperture2D']
@@ -472,10 +472,10 @@ class Recorder(Plot_Handler):
 
             data = deepcopy(self.reader.get_radardata(t))
             data.gps_pos, data.attitude = self.get_positions(t), self.get_attitudes(t)
-            img_border = 255*np.ones(np.shape(data.img))
+            img_border = np.full(np.shape(data.img), 255, np.uint8)
             img_border[border:-border,border:-border] = data.img[border:-border,border:-border]
             data.img = img_border
-            img_overlay = np.nan_to_num(data.predict_image(gps_pos + self.kalman.mapdata.attitude.apply(center,True), self.kalman.mapdata.attitude, shape))
+            img_overlay, _ = data.predict_image(gps_pos + self.kalman.mapdata.attitude.apply(center,True), self.kalman.mapdata.attitude, shape)
             error = np.min([np.linalg.norm(self.get_kalman_error(t)[0][0:2]), bar_scale])
             return increase_saturation(np.nan_to_num(img)), increase_saturation(img_overlay), error
 
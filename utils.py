@@ -12,17 +12,126 @@ from sklearn.cluster import DBSCAN
 from pykml.factory import KML_ElementMaker as kml
 from scipy.spatial.transform import Rotation as rot
 
-def ECC_estimation(img1, img2):
-    """ Estimate the affine transformation from img1 to img2 with ECC"""
+try:
+    from merge_kernel import merge_kernel
+except ImportError:
+    merge_kernel = None
+
+# ECC parameters
+ECC_ITERATIONS = 200        # maximum number of iterations at the coarsest level
+ECC_EPS = 1e-4              # minimal increment of the correlation coefficient
+ECC_GAUSS_FILT_SIZE = 5     # size of the Gaussian filter applied on the images before ECC
+ECC_LEVELS = 3              # number of pyramid levels below full resolution
+ECC_USE_CUDA = False        # (experimental) run ECC on GPU when OpenCV is built with CUDA and a device is available
+
+# The GPU ECC needs the cudaarithm, cudafilters and cudawarping modules of OpenCV
+CUDA_AVAILABLE = (hasattr(cv2, 'cuda') and all(hasattr(cv2.cuda, f) for f in ('createGaussianFilter', 'createLinearFilter', 'warpAffine', 'add', 'multiply', 'addWeighted', 'sum'))
+                  and cv2.cuda.getCudaEnabledDeviceCount() > 0)
+
+def ECC_estimation(img1, img2, levels=ECC_LEVELS):
+    """ Estimate the affine transformation from img1 to img2 with ECC, from coarse to fine resolution """
     warp_mode = cv2.MOTION_EUCLIDEAN
-    number_of_iterations = 500;
-    termination_eps = 1e-7;
-    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, number_of_iterations,  termination_eps)
+    min_size = 32
+    
+    # Image pyramids, from full resolution to the coarsest level
+    pyr1, pyr2 = [img1], [img2]
+    while len(pyr1) <= levels and min(np.shape(pyr1[-1])[:2]) >= 2*min_size:
+        pyr1.append(cv2.pyrDown(pyr1[-1]))
+        pyr2.append(cv2.pyrDown(pyr2[-1]))
     
     warp_matrix = np.eye(2, 3, dtype=np.float32)
-    (cc, warp_matrix) = cv2.findTransformECC (img1, img2, warp_matrix, warp_mode, criteria, None, 1)
+    for level in range(len(pyr1)-1, -1, -1):
+        # Most of the iterations are done on the coarsest levels
+        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, max(ECC_ITERATIONS >> (len(pyr1)-1-level), 1),  ECC_EPS)
+        init_warp = warp_matrix.copy()
+        try:
+            if ECC_USE_CUDA and CUDA_AVAILABLE:
+                (cc, warp_matrix) = ECC_estimation_cuda(pyr1[level], pyr2[level], warp_matrix, criteria, ECC_GAUSS_FILT_SIZE)
+            else:
+                (cc, warp_matrix) = cv2.findTransformECC (pyr1[level], pyr2[level], warp_matrix, warp_mode, criteria, None, ECC_GAUSS_FILT_SIZE)
+        except cv2.error:
+            # A coarse level can fail to converge, the finer level starts again from the previous estimate
+            if level == 0:
+                raise
+            warp_matrix = init_warp
+        if level > 0:
+            warp_matrix[:,2] *= 2
     return cc, warp_matrix
 
+def ECC_estimation_cuda(img1, img2, warp_matrix, criteria, gauss_filt_size=ECC_GAUSS_FILT_SIZE):
+    """ Estimate the euclidean transformation from img1 to img2 with ECC on GPU (same algorithm as cv2.findTransformECC) """
+    shape = (np.shape(img1)[1], np.shape(img1)[0])
+    image_flags = cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP
+    mask_flags = cv2.INTER_NEAREST + cv2.WARP_INVERSE_MAP
+    
+    def upload(array):
+        gpu_array = cv2.cuda_GpuMat()
+        gpu_array.upload(np.ascontiguousarray(array, np.float32))
+        return gpu_array
+    
+    def dot(a, b):
+        return cv2.cuda.sum(cv2.cuda.multiply(a, b))[0]
+    
+    # Smoothed images and gradients of img2
+    gauss = cv2.cuda.createGaussianFilter(cv2.CV_32F, cv2.CV_32F, (gauss_filt_size, gauss_filt_size), 0)
+    template = gauss.apply(upload(img1))
+    image = gauss.apply(upload(img2))
+    grad_x = cv2.cuda.createLinearFilter(cv2.CV_32F, cv2.CV_32F, np.array([[-0.5, 0, 0.5]], np.float32)).apply(image)
+    grad_y = cv2.cuda.createLinearFilter(cv2.CV_32F, cv2.CV_32F, np.array([[-0.5], [0], [0.5]], np.float32)).apply(image)
+    ones = upload(np.ones(np.shape(img2)))
+    x_grid = upload(np.tile(np.arange(shape[0]), (shape[1], 1)))
+    y_grid = upload(np.tile(np.arange(shape[1]).reshape(-1,1), (1, shape[0])))
+    
+    warp_matrix = np.array(warp_matrix, np.float32)
+    rho, last_rho = -1, -criteria[2]
+    for i in range(criteria[1]):
+        if abs(rho - last_rho) < criteria[2]:
+            break
+        
+        # Warp img2 and its gradients back to img1 frame, restricted to the valid area
+        mask = cv2.cuda.warpAffine(ones, warp_matrix, shape, flags=mask_flags)
+        img_warped = cv2.cuda.multiply(cv2.cuda.warpAffine(image, warp_matrix, shape, flags=image_flags), mask)
+        grad_x_warped = cv2.cuda.multiply(cv2.cuda.warpAffine(grad_x, warp_matrix, shape, flags=image_flags), mask)
+        grad_y_warped = cv2.cuda.multiply(cv2.cuda.warpAffine(grad_y, warp_matrix, shape, flags=image_flags), mask)
+        template_masked = cv2.cuda.multiply(template, mask)
+        
+        # Zero-mean images on the valid area
+        n = cv2.cuda.sum(mask)[0]
+        img_zm = cv2.cuda.addWeighted(img_warped, 1, mask, -cv2.cuda.sum(img_warped)[0]/n, 0)
+        template_zm = cv2.cuda.addWeighted(template_masked, 1, mask, -cv2.cuda.sum(template_masked)[0]/n, 0)
+        img_norm = np.sqrt(dot(img_zm, img_zm))
+        template_norm = np.sqrt(dot(template_zm, template_zm))
+        
+        # Jacobian of the warped image with respect to (theta, tx, ty)
+        c, s = warp_matrix[0,0], warp_matrix[1,0]
+        jacobian_theta = cv2.cuda.add(cv2.cuda.addWeighted(cv2.cuda.multiply(grad_y_warped, x_grid), c, cv2.cuda.multiply(grad_x_warped, y_grid), -c, 0),
+                                      cv2.cuda.addWeighted(cv2.cuda.multiply(grad_x_warped, x_grid), -s, cv2.cuda.multiply(grad_y_warped, y_grid), -s, 0))
+        jacobian = [jacobian_theta, grad_x_warped, grad_y_warped]
+        hessian_inv = np.linalg.inv(np.array([[dot(a, b) for b in jacobian] for a in jacobian]))
+        
+        correlation = dot(template_zm, img_zm)
+        last_rho, rho = rho, correlation/(img_norm*template_norm)
+        if np.isnan(rho):
+            raise cv2.error("NaN encountered.")
+        
+        img_projection = np.array([dot(j, img_zm) for j in jacobian])
+        template_projection = np.array([dot(j, template_zm) for j in jacobian])
+        img_projection_hessian = hessian_inv.dot(img_projection)
+        lambda_n = img_norm**2 - img_projection.dot(img_projection_hessian)
+        lambda_d = correlation - template_projection.dot(img_projection_hessian)
+        if lambda_d <= 0:
+            raise cv2.error("The algorithm stopped before its convergence. The correlation is going to be minimized.")
+        
+        # Update of the warp matrix (projection of the error is linear in the projections above)
+        delta = hessian_inv.dot(lambda_n/lambda_d*template_projection - img_projection)
+        theta = np.arcsin(warp_matrix[1,0]) + delta[0]
+        warp_matrix[0,2] += delta[1]
+        warp_matrix[1,2] += delta[2]
+        warp_matrix[0,0] = warp_matrix[1,1] = np.cos(theta)
+        warp_matrix[1,0] = np.sin(theta)
+        warp_matrix[0,1] = -np.sin(theta)
+    return rho, warp_matrix
+
 def feature_matching_estimation(img1, img2, algorithm="ORB"):
     """ Estimate the affine transformation from img1 to img2 with feature matching algorithms"""
     if not(algorithm=="ORB" or algorithm=="SIFT"):
@@ -176,6 +285,22 @@ def rotation_proj(attitude1, attitude2):
     r = attitude1.apply(attitude2.apply([1,0,0],True))
     return rot.from_dcm(np.array([[r[0], -r[1], 0.],[r[1], r[0], 0.],[0., 0., 1.]]))
 
+def quat_mul(q1, q2):
+    """ Hamilton product of two quaternions in scipy order (x, y, z, w) """
+    x1, y1, z1, w1 = q1
+    x2, y2, z2, w2 = q2
+    return (w1*x2 + x1*w2 + y1*z2 - z1*y2,
+            w1*y2 - x1*z2 + y1*w2 + z1*x2,
+            w1*z2 + x1*y2 - y1*x2 + z1*w2,
+            w1*w2 - x1*x2 - y1*y2 - z1*z2)
+
+def rotation_proj_matrix(q1, q2):
+    """ Return the 2x2 matrix of rotation_proj from the quaternions of attitude1 and attitude2 """
+    x, y, z, w = quat_mul(q1, (-q2[0], -q2[1], -q2[2], q2[3]))
+    # Image of the x axis by attitude1*attitude2.inv(), projected on the XY plane
+    c, s = 1 - 2*(y*y + z*z), 2*(x*y + w*z)
+    return np.array([[c, -s],[s, c]])/np.hypot(c, s)
+
 def rotation_ort(attitude1, attitude2):
     """ Return the complement rotation from the projection on Z axis from attitude1 to attitude2 """
     ort = attitude2*attitude1.inv()*rotation_proj(attitude1, attitude2)
@@ -232,16 +357,29 @@ def check_transform(data, rotation, translation, name):
     warp_matrix = np.concatenate(((rotation.as_dcm()[:2,:2]).T,np.array([[-translation[0]],[-translation[1]]])), axis = 1)
     Image.fromarray(cv2.warpAffine(data.img, warp_matrix, shape, flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)).save(name);    
 
-def merge_img(img1, img2, P1, P2):
-    """ Merge two images pixel by pixel, weighted by uncertainty, only in modified area """
-    img = deepcopy(img1)
-    cov_img = deepcopy(P1)
-     
-    mask1 = np.isnan(img1)
-    mask2 = np.isnan(img2)
+def merge_img(img1, img2, P1, P2, sl=None):
+    """ Merge two images pixel by pixel, weighted by uncertainty, only in modified area 
+        sl: (rows, columns) slices where the images are merged, img1 and P1 are kept elsewhere
+    """
+    if sl is None:
+        sl = (slice(None), slice(None))
+    img = img1.astype(np.result_type(img1, img2))
+    cov_img = P1.astype(np.result_type(P1, P2))
+    if not merge_kernel is None:
+        # Single fused pass with numba when available, on the full arrays so that the slices are not copied
+        r0, r1, _ = sl[0].indices(np.size(img1,0))
+        c0, c1, _ = sl[1].indices(np.size(img1,1))
+        merge_kernel(img1, img2, P1, P2, img, cov_img, r0, r1, c0, c1)
+        return img, cov_img
+    
+    img1, img2, P1, P2 = img1[sl], img2[sl], P1[sl], P2[sl]
+    nan1 = np.isnan(img1)
+    nan2 = np.isnan(img2)
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = np.rint((img1*P2 + img2*P1)/(P1 + P2))
+        cov_out = P1*P2/(P1 + P2)
     
-    np.putmask(img, mask1, img2)
-    np.putmask(cov_img, mask1, P2)
-    np.putmask(img, np.logical_and(np.logical_not(mask1), np.logical_not(mask2)), np.round(np.divide(np.multiply(img1, P2) + np.multiply(img2, P1), P1 + P2)))
-    np.putmask(cov_img, np.logical_and(np.logical_not(mask1), np.logical_not(mask2)), np.divide(np.multiply(P1, P2), P1 + P2))
+    img[sl] = np.where(nan1, img2, np.where(nan2, img1, out))
+    cov_img[sl] = np.where(nan1, P2, np.where(nan2, P1, cov_out))
     return img, cov_img